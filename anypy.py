@@ -3,105 +3,441 @@
 
 from __future__ import annotations
 
+# Heavier modules (tarfile, urllib.request, subprocess, ...) are imported
+# inside the functions that need them so that `--help` and argparse errors do
+# not pay their import cost
 import argparse
+import functools
+import importlib
+import io
+import os
 import pathlib
-import platform
-import shutil
-import subprocess
+import queue
 import sys
-import tarfile
-import tempfile
-import urllib.request
+import threading
 
 if not (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
     raise RuntimeError('You need at least python3.7+ to run this tool!')
 
-ARCHITECTURES = [
+
+@functools.lru_cache(maxsize=None)
+def _optional_import(name: str):
+    '''Imports the optional accelerator module `name` if it is installed'''
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _pool():
+    '''A shared urllib3 PoolManager, or None when urllib3 is not installed'''
+    urllib3 = _optional_import('urllib3')
+    if urllib3 is None:
+        return None
+    return urllib3.PoolManager(maxsize=4,
+                               retries=urllib3.Retry(3, backoff_factor=0.3))
+
+ARCHITECTURES = (
     'x86_64',
     'aarch64',
     'armv7',
-]
-
-RELEASE_MAP = {
-    '3.8.9': '20210415',
-    '3.8.10': '20210506',
-    '3.8.11': '20210724',
-    '3.8.12': '20220227',
-    '3.8.13': '20220802',
-    '3.8.14': '20221002',
-    '3.8.15': '20221106',
-    '3.8.16': '20230726',
-    '3.8.17': '20230826',
-    '3.8.18': '20240224',
-    '3.8.19': '20240814',
-    '3.8.20': '20240909',
-    '3.9.4': '20210415',
-    '3.9.5': '20210506',
-    '3.9.6': '20210724',
-    '3.9.7': '20211017',
-    '3.9.10': '20220227',
-    '3.9.11': '20220318',
-    '3.9.12': '20220502',
-    '3.9.13': '20220802',
-    '3.9.14': '20221002',
-    '3.9.15': '20221106',
-    '3.9.16': '20230507',
-    '3.9.17': '20230726',
-    '3.9.18': '20240224',
-    '3.9.19': '20240814',
-    '3.9.20': '20241016',
-    '3.10.0': '20211017',
-    '3.10.2': '20220227',
-    '3.10.3': '20220318',
-    '3.10.4': '20220528',
-    '3.10.5': '20220630',
-    '3.10.6': '20220802',
-    '3.10.7': '20221002',
-    '3.10.8': '20221106',
-    '3.10.9': '20230116',
-    '3.10.11': '20230507',
-    '3.10.12': '20230726',
-    '3.10.13': '20240224',
-    '3.10.14': '20240814',
-    '3.10.15': '20241016',
-    '3.11.1': '20230116',
-    '3.11.3': '20230507',
-    '3.11.4': '20230726',
-    '3.11.5': '20230826',
-    '3.11.6': '20231002',
-    '3.11.7': '20240107',
-    '3.11.8': '20240224',
-    '3.11.9': '20240814',
-    '3.11.10': '20241016',
-    '3.12.0': '20231002',
-    '3.12.1': '20240107',
-    '3.12.2': '20240224',
-    '3.12.3': '20240415',
-    '3.12.4': '20240726',
-    '3.12.5': '20240814',
-    '3.12.6': '20240909',
-    '3.12.7': '20241016',
-    '3.13.0': '20241016',
-}
-
-
-def _cached_download(url: str, output: pathlib.Path):
+)
+_ARCH_SET = frozenset(ARCHITECTURES)
+
+# Version -> release date, sorted by version; kept as a flat tuple so module
+# import only pays for one constant, with the lookup dict built on demand
+_RELEASES = (
+    ('3.8.9', '20210415'),
+    ('3.8.10', '20210506'),
+    ('3.8.11', '20210724'),
+    ('3.8.12', '20220227'),
+    ('3.8.13', '20220802'),
+    ('3.8.14', '20221002'),
+    ('3.8.15', '20221106'),
+    ('3.8.16', '20230726'),
+    ('3.8.17', '20230826'),
+    ('3.8.18', '20240224'),
+    ('3.8.19', '20240814'),
+    ('3.8.20', '20240909'),
+    ('3.9.4', '20210415'),
+    ('3.9.5', '20210506'),
+    ('3.9.6', '20210724'),
+    ('3.9.7', '20211017'),
+    ('3.9.10', '20220227'),
+    ('3.9.11', '20220318'),
+    ('3.9.12', '20220502'),
+    ('3.9.13', '20220802'),
+    ('3.9.14', '20221002'),
+    ('3.9.15', '20221106'),
+    ('3.9.16', '20230507'),
+    ('3.9.17', '20230726'),
+    ('3.9.18', '20240224'),
+    ('3.9.19', '20240814'),
+    ('3.9.20', '20241016'),
+    ('3.10.0', '20211017'),
+    ('3.10.2', '20220227'),
+    ('3.10.3', '20220318'),
+    ('3.10.4', '20220528'),
+    ('3.10.5', '20220630'),
+    ('3.10.6', '20220802'),
+    ('3.10.7', '20221002'),
+    ('3.10.8', '20221106'),
+    ('3.10.9', '20230116'),
+    ('3.10.11', '20230507'),
+    ('3.10.12', '20230726'),
+    ('3.10.13', '20240224'),
+    ('3.10.14', '20240814'),
+    ('3.10.15', '20241016'),
+    ('3.11.1', '20230116'),
+    ('3.11.3', '20230507'),
+    ('3.11.4', '20230726'),
+    ('3.11.5', '20230826'),
+    ('3.11.6', '20231002'),
+    ('3.11.7', '20240107'),
+    ('3.11.8', '20240224'),
+    ('3.11.9', '20240814'),
+    ('3.11.10', '20241016'),
+    ('3.12.0', '20231002'),
+    ('3.12.1', '20240107'),
+    ('3.12.2', '20240224'),
+    ('3.12.3', '20240415'),
+    ('3.12.4', '20240726'),
+    ('3.12.5', '20240814'),
+    ('3.12.6', '20240909'),
+    ('3.12.7', '20241016'),
+    ('3.13.0', '20241016'),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _release_map() -> dict:
+    return dict(_RELEASES)
+
+
+def _cache_path(url: str) -> pathlib.Path:
     user_cache = pathlib.Path.home() / '.cache' / 'anypy'
     user_cache.mkdir(parents=True, exist_ok=True)
-    file_name = pathlib.Path(url).name
-    cached_file = user_cache / file_name
+    return user_cache / pathlib.Path(url).name
+
+
+class _QueueReader(io.RawIOBase):
+    '''File-like view over the chunks a background reader thread produces
+
+    The producer puts `bytes` chunks, an `Exception` on failure, or `None`
+    at end of stream.
+    '''
+
+    def __init__(self, chunks: queue.Queue):
+        self._chunks = chunks
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            item = self._chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                self._eof = True
+            else:
+                self._buffer = item
+        count = min(len(buffer), len(self._buffer))
+        buffer[:count] = self._buffer[:count]
+        self._buffer = self._buffer[count:]
+        return count
+
+
+def _read_chunks(resp, sink, chunks: queue.Queue):
+    '''Producer half of the download pipeline: pulls 1 MiB chunks off the HTTP
+    response, tees them into the cache `sink` and hands them to the extractor
+    through a bounded queue, keeping the TCP window filling while the main
+    thread inflates
+    '''
+    try:
+        for chunk in iter(lambda: resp.read(1 << 20), b''):
+            sink.write(chunk)
+            chunks.put(chunk)
+        chunks.put(None)
+    except Exception as error:
+        chunks.put(error)
+
+
+def _open_url(url: str):
+    '''Opens `url` for reading, reusing pooled connections when urllib3 is around'''
+    import urllib.request
+    # The assets are already compressed; identity transfer keeps
+    # Content-Length meaningful and avoids pointless proxy recompression
+    headers = {'Accept-Encoding': 'identity'}
+    pool = _pool()
+    if pool is not None:
+        return pool.request('GET', url, headers=headers, preload_content=False)
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+
+
+def _url_exists(url: str) -> bool:
+    import urllib.request
+    try:
+        pool = _pool()
+        if pool is not None:
+            return pool.request('HEAD', url).status < 400
+        with urllib.request.urlopen(
+                urllib.request.Request(url, method='HEAD')):
+            return True
+    except Exception:
+        return False
+
+
+def _open_tar(url: str, fileobj) -> tarfile.TarFile:
+    '''Opens the archive behind `url` for reading, picking the decompressor
+    from its suffix. Streaming mode ('r|') keeps decompression strictly
+    forward, which works for live HTTP responses and cached files alike
+    '''
+    import tarfile
+    if url.endswith('.tar.zst'):
+        zstandard = _optional_import('zstandard')
+        reader = zstandard.ZstdDecompressor().stream_reader(fileobj,
+                                                            read_size=1 << 20)
+        return tarfile.open(fileobj=reader, mode='r|')
+    igzip = _optional_import('isal.igzip')
+    if igzip is not None:
+        # ISA-L decodes DEFLATE with SIMD, roughly twice as fast as stdlib gzip
+        return tarfile.open(fileobj=igzip.IGzipFile(fileobj=fileobj),
+                            mode='r|')
+    return tarfile.open(fileobj=fileobj, mode='r|gz')
+
+
+def _sha256(path: pathlib.Path) -> str:
+    import hashlib
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # 3.11+; picks up SHA-NI / ARMv8 SHA2 where the CPU has it
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def _cache_intact(cached_file: pathlib.Path) -> bool:
+    '''Checks the cached archive against the digest recorded at download time;
+    hardware SHA makes this cheap enough to gate every cache hit
+    '''
+    sha_file = cached_file.with_name(cached_file.name + '.sha256')
+    if not sha_file.exists():
+        return True
+    return _sha256(cached_file) == sha_file.read_text()
+
+
+def _save_digest(cached_file: pathlib.Path):
+    cached_file.with_name(cached_file.name +
+                          '.sha256').write_text(_sha256(cached_file))
+
+
+def _save_etag(resp, cached_file: pathlib.Path):
+    etag = resp.headers.get('ETag')
+    if etag:
+        cached_file.with_name(cached_file.name + '.etag').write_text(etag)
+
+
+def _cache_valid(url: str, cached_file: pathlib.Path) -> bool:
+    '''Revalidates a cached asset with a conditional HEAD when its ETag is
+    known. Tagged release assets are immutable, so this normally costs a
+    single 304 round trip; offline runs keep trusting the cache
+    '''
+    import urllib.request
+    etag_file = cached_file.with_name(cached_file.name + '.etag')
+    if not etag_file.exists():
+        return True
+    headers = {'If-None-Match': etag_file.read_text()}
+    try:
+        pool = _pool()
+        if pool is not None:
+            return pool.request('HEAD', url, headers=headers).status != 200
+        with urllib.request.urlopen(
+                urllib.request.Request(url, method='HEAD',
+                                       headers=headers)) as resp:
+            return resp.status != 200
+    except Exception:
+        return True
+
+
+def _check_complete(resp, url: str, tmp_file: pathlib.Path):
+    '''Raises if the downloaded `tmp_file` is shorter than the server promised,
+    so a connection dropped mid-body never gets renamed into the cache
+    '''
+    length = resp.headers.get('Content-Length')
+    size = tmp_file.stat().st_size
+    if length is not None and size != int(length):
+        tmp_file.unlink()
+        raise RuntimeError(
+            f'Incomplete download of {url}: got {size} of {length} bytes')
+
+
+def _stream_extract(url: str, location: pathlib.Path):
+    '''Extracts the tarball at `url` into `location` as it downloads, filling the cache
+    on the side so the archive never has to be fetched twice
+    '''
+    cached_file = _cache_path(url)
+    tmp_file = cached_file.with_name(cached_file.name + '.tmp')
+    resp = _open_url(url)
+    chunks = queue.Queue(maxsize=8)
+    try:
+        with open(tmp_file, 'wb') as sink:
+            reader = threading.Thread(target=_read_chunks,
+                                      args=(resp, sink, chunks),
+                                      daemon=True)
+            reader.start()
+            stream = io.BufferedReader(_QueueReader(chunks),
+                                       buffer_size=1 << 20)
+            with _open_tar(url, stream) as pytar:
+                _parallel_extractall(pytar, location)
+            reader.join()
+    except BaseException:
+        if tmp_file.exists():
+            tmp_file.unlink()
+        raise
+    finally:
+        resp.close()
+    _check_complete(resp, url, tmp_file)
+    tmp_file.replace(cached_file)
+    _save_etag(resp, cached_file)
+    _save_digest(cached_file)
+
+
+def _parallel_extractall(tar: tarfile.TarFile, dest: pathlib.Path):
+    '''Extracts `tar` into `dest`, fanning the per-file writes out to a thread pool
+
+    Tar archives must be read in order, so members are decompressed
+    sequentially; it is the open/write/close/chmod syscalls for each of the
+    thousands of files that get overlapped (python releases the GIL around
+    I/O). A semaphore bounds how many decompressed entries sit in memory
+    waiting for their write to finish.
+    '''
+    in_flight = threading.Semaphore(64)
+    made_dirs = {dest}
+
+    def ensure_parent(path: pathlib.Path):
+        # Memoize the whole ancestor chain so each directory costs exactly one
+        # mkdir; the round-trips otherwise dominate on networked filesystems
+        parent = path.parent
+        if parent in made_dirs:
+            return
+        parent.mkdir(parents=True, exist_ok=True)
+        while parent not in made_dirs:
+            made_dirs.add(parent)
+            parent = parent.parent
+
+    def write_entry(path: pathlib.Path, data: bytes, mode: int):
+        try:
+            # One write() per file: the entry is already whole in memory, so
+            # skip the buffered layer and its copy. Partial writes are rare
+            # for regular files but handled anyway
+            with open(path, 'wb', buffering=0) as f:
+                view = memoryview(data)
+                while len(view):
+                    view = view[f.write(view):]
+            # Archive timestamps are irrelevant for a scratch install and the
+            # default mode is fine for plain files; only executables need a
+            # chmod. Each skipped syscall adds up over thousands of entries
+            if mode & 0o111:
+                os.chmod(path, mode)
+        finally:
+            in_flight.release()
+
+    futures = []
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        for member in tar:
+            path = dest / member.name
+            if member.isdir():
+                path.mkdir(parents=True, exist_ok=True)
+                made_dirs.add(path)
+            elif member.issym():
+                ensure_parent(path)
+                if path.is_symlink() or path.exists():
+                    path.unlink()
+                os.symlink(member.linkname, path)
+            elif member.isreg():
+                data = tar.extractfile(member).read()
+                ensure_parent(path)
+                in_flight.acquire()
+                futures.append(
+                    pool.submit(write_entry, path, data, member.mode))
+            else:
+                # Hardlinks and other rarities may reference files still being
+                # written; drain pending writes before handing off to tarfile
+                for future in futures:
+                    future.result()
+                futures.clear()
+                tar.extract(member, dest)
+        for future in futures:
+            future.result()
+
+
+_EXTRACT_LOCK = threading.Lock()
+
+
+def _extract_cached(cached_file: pathlib.Path, url: str,
+                    location: pathlib.Path):
+    '''Extracts the cached archive into `location`, through libarchive's C
+    entry loop when the optional libarchive-c package is installed, falling
+    back to the tarfile thread pool
+    '''
+    libarchive = _optional_import('libarchive')
+    if libarchive is not None:
+        # libarchive extracts into the working directory; the lock keeps the
+        # process-global chdir safe under concurrent installs
+        with _EXTRACT_LOCK:
+            cwd = os.getcwd()
+            os.chdir(location)
+            try:
+                libarchive.extract_file(str(cached_file))
+            finally:
+                os.chdir(cwd)
+        return
+    with open(cached_file, 'rb') as f:
+        with _open_tar(url, f) as pytar:
+            _parallel_extractall(pytar, location)
+
+
+def _ensure_cached(url: str) -> pathlib.Path:
+    '''Returns the cached copy of `url`, downloading it first if absent or stale'''
+    cached_file = _cache_path(url)
+    if cached_file.exists() and not (_cache_intact(cached_file)
+                                     and _cache_valid(url, cached_file)):
+        cached_file.unlink()
     if not cached_file.exists():
-        urllib.request.urlretrieve(url, cached_file)
-    shutil.copy2(cached_file, output)
+        tmp_file = cached_file.with_name(cached_file.name + '.tmp')
+        resp = _open_url(url)
+        try:
+            with open(tmp_file, 'wb') as f:
+                for chunk in iter(lambda: resp.read(1 << 20), b''):
+                    f.write(chunk)
+        except BaseException:
+            if tmp_file.exists():
+                tmp_file.unlink()
+            raise
+        finally:
+            resp.close()
+        _check_complete(resp, url, tmp_file)
+        tmp_file.replace(cached_file)
+        _save_etag(resp, cached_file)
+        _save_digest(cached_file)
+    return cached_file
 
 
+@functools.lru_cache(maxsize=None)
 def _get_link(version: str, arch: str) -> str:
-    if arch not in ARCHITECTURES:
+    if arch not in _ARCH_SET:
         raise RuntimeError(f'Unsupported architecture: {arch}')
     if arch == 'x86_64':
         # As per https://gregoryszorc.com/docs/python-build-standalone/main/running.html
         arch += '_v3'
-    release = RELEASE_MAP[version]
+    release = _release_map()[version]
     link = (
         'https://github.com/indygreg/python-build-standalone/releases/download/'
         f'{release}/cpython-{version}+{release}-{arch}-'
@@ -109,6 +445,19 @@ def _get_link(version: str, arch: str) -> str:
     return link
 
 
+def _pick_link(version: str, arch: str) -> str:
+    '''Prefers the zstd variant of the release archive when the `zstandard`
+    module is installed and the asset exists upstream; zstd decompresses
+    several times faster than gzip. Falls back to the .tar.gz archive
+    '''
+    link = _get_link(version, arch)
+    if _optional_import('zstandard') is not None:
+        zst_link = link[:-len('.gz')] + '.zst'
+        if _cache_path(zst_link).exists() or _url_exists(zst_link):
+            return zst_link
+    return link
+
+
 def download(version: str, arch: str, location: pathlib.Path) -> pathlib.Path:
     '''Downloads a standalone `version` of python binary at `location` for the specified
     `arch`
@@ -118,13 +467,11 @@ def download(version: str, arch: str, location: pathlib.Path) -> pathlib.Path:
     location.mkdir(exist_ok=True, parents=True)
     gitignore = location / '.gitignore'
     gitignore.write_text('*')
-    link = _get_link(version, arch)
-    with tempfile.TemporaryDirectory() as tmp_:
-        pytarf = pathlib.Path(tmp_) / f'py-{version}.tar.zst'
-        # urllib.request.urlretrieve(link, pytarf)
-        _cached_download(link, pytarf)
-        with tarfile.open(pytarf) as pytar:
-            pytar.extractall(location)
+    link = _pick_link(version, arch)
+    if _cache_path(link).exists():
+        _extract_cached(_ensure_cached(link), link, location)
+    else:
+        _stream_extract(link, location)
 
     major = version.split('.')[0]
     return pathlib.Path(location, 'python', 'bin', f'python{major}')
@@ -133,9 +480,21 @@ def download(version: str, arch: str, location: pathlib.Path) -> pathlib.Path:
 def _venv(py_bin: pathlib.Path, location: pathlib.Path):
     location = location / '.venv'
     print(f'Creating virtual environment at {location}')
-    subprocess.run(f'{py_bin} -m venv --system-site-packages {location}',
-                   shell=True,
-                   check=True)
+    if pathlib.Path(sys.executable).resolve() == py_bin.resolve():
+        # The venv must be built by the target interpreter, which is normally
+        # not the one running this script; when it happens to be (e.g. anypy
+        # invoked by the very version it just downloaded), build in-process
+        # and skip a whole interpreter boot
+        import venv as venv_builder
+        venv_builder.EnvBuilder(system_site_packages=True,
+                                with_pip=True).create(location)
+    else:
+        import subprocess
+        subprocess.run([
+            str(py_bin), '-m', 'venv', '--system-site-packages',
+            str(location)
+        ],
+                       check=True)
     gitignore = location / '.gitignore'
     gitignore.write_text('*')
 
@@ -153,12 +512,18 @@ def venv(version: str, arch: str, location: pathlib.Path):
 
 
 if __name__ == '__main__':
+    import platform
     parser = argparse.ArgumentParser(
         description='Create a Python Virtual Environment '
         'with a standalone version of Python',
         epilog='Supported Python versions: '
-        f'{list(RELEASE_MAP.keys())}')
-    parser.add_argument('version', type=str, help='The Python version')
+        f'{[version for version, _ in _RELEASES]}')
+    parser.add_argument(
+        'version',
+        type=str,
+        nargs='+',
+        help='The Python version; passing several installs each one '
+        'concurrently under <location>/<version>')
     parser.add_argument(
         '-l',
         '--location',
@@ -181,7 +546,19 @@ if __name__ == '__main__':
     )
     args = parser.parse_args()
 
-    if args.python_only:
-        download(args.version, args.arch, args.location)
+    action = download if args.python_only else venv
+    if len(args.version) == 1:
+        action(args.version[0], args.arch, args.location)
     else:
-        venv(args.version, args.arch, args.location)
+        # Each version is independent network + CPU work, so a few in
+        # flight at once saturates both
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(4, len(args.version))) as pool:
+            tasks = [
+                pool.submit(action, version, args.arch,
+                            args.location / version)
+                for version in args.version
+            ]
+            for task in tasks:
+                task.result()